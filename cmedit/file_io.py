@@ -18,7 +18,8 @@
 #
 # Copyright (C) 2021-2022 Michael Vigovsky
 
-import os, re, json, numpy
+import os, re, json, collections, numpy
+from concurrent.futures import ThreadPoolExecutor
 import bpy, bpy_extras, bmesh, idprop  # pylint: disable=import-error
 
 from ..lib import morphs, utils
@@ -34,8 +35,27 @@ prop_precision = bpy.props.EnumProperty(
     ]
 )
 
+prop_morph_precision = bpy.props.EnumProperty(
+    name="Precision",
+    description="Floating point precision for morph npz files",
+    default="32",
+    items=[
+        ("16", "16 bits", "IEEE Half precision floating point (smaller files, only for small morph deltas)"),
+        ("32", "32 bits", "IEEE Single precision floating point"),
+        ("64", "64 bits", "IEEE Double precision floating point"),
+    ]
+)
+
+prop_compress = bpy.props.BoolProperty(
+    name="Compress",
+    description="Compress npz file. Uncompressed files are written much faster but take more space",
+    default=True,
+)
+
 
 def float_dtype(value):
+    if value == "16":
+        return numpy.float16
     return numpy.float64 if value == "64" else numpy.float32
 
 
@@ -47,13 +67,16 @@ class OpHairExport(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
 
     filter_glob: bpy.props.StringProperty(default="*.npz", options={'HIDDEN'})
     precision: prop_precision
+    compress: prop_compress
 
     @classmethod
     def poll(cls, context):
         return context.object and context.object.particle_systems.active
 
     def execute(self, context):
-        export_hair(context.object, context.object.particle_systems.active_index, self.filepath, float_dtype(self.precision))
+        export_hair(
+            context.object, context.object.particle_systems.active_index,
+            self.filepath, float_dtype(self.precision), self.compress)
         return {"FINISHED"}
 
 
@@ -96,18 +119,26 @@ class OpAllHairExport(DirExport):
     bl_label = "Export all hair"
     bl_description = "Export all hairstyles to .npz files"
 
+    compress: prop_compress
+
     def execute(self, context):
         for i, psys in enumerate(context.object.particle_systems):
-            export_hair(context.object, i, os.path.join(self.directory, psys.name + ".npz"), float_dtype(self.precision))
+            export_hair(
+                context.object, i, os.path.join(self.directory, psys.name + ".npz"),
+                float_dtype(self.precision), self.compress)
         return {"FINISHED"}
 
 
 def flatten(arr, dtype):
-    return numpy.block([numpy.array(item, dtype=dtype) for item in arr])
+    # Items are typed buffers, so concatenate them in one go and cast the result only once
+    return numpy.concatenate(arr).astype(dtype=dtype, copy=False)
 
 
 def get_bits(arr):
-    num = max(arr, default=0)
+    if isinstance(arr, numpy.ndarray):
+        num = arr.max(initial=0)
+    else:
+        num = max(arr, default=0)
     if num >= 65536:
         return numpy.uint32
     if num >= 256:
@@ -123,6 +154,7 @@ class OpVgExport(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
 
     filter_glob: bpy.props.StringProperty(default="*.npz", options={'HIDDEN'})
     precision: prop_precision
+    compress: prop_compress
     regex: bpy.props.StringProperty(
         name="VG regex",
         description="Regular expression for vertex group export",
@@ -141,8 +173,8 @@ class OpVgExport(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
             self.report({"ERROR"}, "No vertex groups match provided regex")
             return {"CANCELLED"}
 
-        numpy.savez_compressed(
-            self.filepath,
+        utils.save_npz(
+            self.filepath, self.compress,
             names=b'\0'.join(name.encode("utf-8") for name in names),
             cnt=numpy.array(cnt, dtype=get_bits(cnt)),
             idx=flatten(idx, numpy.uint16),
@@ -267,13 +299,21 @@ class OpExportL1(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
 
 
 def morph_idx_epsilon(diff: numpy.ndarray, epsilon: float) -> numpy.ndarray:
-    idx = ((diff ** 2).sum(1) > epsilon ** 2).nonzero()[0]
+    # einsum computes squared lengths without materializing the squared (N, 3) array
+    idx = (numpy.einsum("ij,ij->i", diff, diff) > epsilon ** 2).nonzero()[0]
     return idx.astype(get_bits(idx))
 
 
-def export_morph(m, path, epsilon, dtype):
+def export_morph(m, path, epsilon, dtype, submit=None):
+    def save(func, *args, **kwargs):
+        if submit is None:
+            func(*args, **kwargs)
+        else:
+            submit(func, *args, **kwargs)
+
     def save_npy():
-        numpy.save(path, m.astype(dtype=dtype, casting="same_kind"))
+        # m can be a reused buffer, so copy it if it's going to be saved asynchronously
+        save(numpy.save, path, m.astype(dtype=dtype, casting="same_kind", copy=submit is not None))
 
     if path[-4:] == ".npy":
         save_npy()
@@ -281,23 +321,29 @@ def export_morph(m, path, epsilon, dtype):
 
     idx = morph_idx_epsilon(m, epsilon)
     if (path[-4:] == ".npz") or len(idx) * 5 <= len(m) * 4:
-        numpy.savez(path, idx=idx, delta=m[idx].astype(dtype=dtype, casting="same_kind"))
+        # m[idx] is already a fresh array, so don't copy it again if dtype matches
+        save(numpy.savez, path, idx=idx, delta=m[idx].astype(dtype=dtype, casting="same_kind", copy=False))
     else:
         save_npy()
 
 
 class MorphExporter:
-    def __init__(self, obj, epsilon, dtype):
+    def __init__(self, obj, epsilon, dtype, submit=None):
         self.obj = obj
         self.epsilon = epsilon
         self.dtype = dtype
+        self.submit = submit
 
         rk = self.obj.data.shape_keys.reference_key
         self.rk = rk
-        self.basis = numpy.empty(len(rk.data) * 3)
-        self.basis2 = numpy.empty(len(rk.data) * 3)
-        self.morphed = numpy.empty(len(rk.data) * 3)
+        # Shape key coordinates are stored as float32, so read them into float32 buffers
+        # to let foreach_get copy memory directly. Upcast only when calculating the difference.
+        self.basis = numpy.empty(len(rk.data) * 3, dtype=numpy.float32)
+        self.basis2 = numpy.empty(len(rk.data) * 3, dtype=numpy.float32)
+        self.morphed = numpy.empty(len(rk.data) * 3, dtype=numpy.float32)
+        self.diff = numpy.empty(len(rk.data) * 3, dtype=numpy.float64 if dtype == numpy.float64 else numpy.float32)
         rk.data.foreach_get("co", self.basis)
+        self.vg_cache = None
 
     def do_export(self, sk, path):
         if sk.relative_key == sk:
@@ -309,20 +355,29 @@ class MorphExporter:
             basis3 = self.basis2
             sk.relative_key.data.foreach_get("co", basis3)
 
-        self.morphed -= basis3
-        m2 = self.morphed.reshape(-1, 3)
+        numpy.subtract(self.morphed, basis3, out=self.diff)
+        m2 = self.diff.reshape(-1, 3)
 
-        if sk.vertex_group:
-            vg = self.obj.vertex_groups[sk.vertex_group].index
-            for i, v in enumerate(self.obj.data.vertices):
-                for e in v.groups:
-                    if e.group == vg:
-                        m2[i] *= e.weight
-                        break
-                else:
-                    m2[i] = (0, 0, 0)
+        # Blender ignores a missing vertex group and applies the shape key in full
+        if sk.vertex_group and sk.vertex_group in self.obj.vertex_groups:
+            m2 *=self.vg_weights(sk.vertex_group)[:, None]
 
-        export_morph(m2, path, self.epsilon, self.dtype)
+        export_morph(m2, path, self.epsilon, self.dtype, self.submit)
+
+    def vg_weights(self, name):
+        if self.vg_cache is None:
+            # Collect all vertex groups used by shape keys in one pass over the vertices
+            vgs = {sk.vertex_group for sk in self.obj.data.shape_keys.key_blocks if sk.vertex_group}
+            self.vg_cache = {
+                vg_name: (numpy.array(idx, dtype=numpy.uint32), numpy.array(weights, dtype=numpy.float32))
+                for vg_name, idx, weights in zip(*utils.vg_weights_to_arrays(self.obj, vgs.__contains__))
+            }
+
+        w = numpy.zeros(len(self.basis) // 3, dtype=numpy.float32)
+        item = self.vg_cache.get(name)
+        if item is not None:
+            w.put(*item)
+        return w
 
 
 prop_cutoff = bpy.props.FloatProperty(
@@ -333,6 +388,11 @@ prop_cutoff = bpy.props.FloatProperty(
 )
 
 
+def check_morph_precision(op):
+    if op.precision == "16" and op.cutoff < numpy.finfo(numpy.float16).tiny:
+        op.report({"WARNING"}, "Cutoff is below half precision resolution, small deltas will lose precision")
+
+
 class OpMorphExport(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
     bl_idname = "cmedit.morph_export"
     bl_label = "Export single morph"
@@ -350,7 +410,7 @@ class OpMorphExport(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
             ("BC", "BMesh cage", "Export BMesh cage that includes all shape keys mix and modifiers result"),
         ]
     )
-    precision: prop_precision
+    precision: prop_morph_precision
     cutoff: prop_cutoff
 
     @classmethod
@@ -358,6 +418,7 @@ class OpMorphExport(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
         return context.object and context.object.type == "MESH" and context.object.active_shape_key
 
     def execute(self, context):
+        check_morph_precision(self)
         if self.mode == "SK":
             exp = MorphExporter(context.object, self.cutoff, float_dtype(self.precision))
             exp.do_export(context.object.active_shape_key, self.filepath)
@@ -396,10 +457,11 @@ class OpMorphsExport(DirExport):
 
     regex: prop_regex
     re_replace: prop_re_replace
-    precision: prop_precision
+    precision: prop_morph_precision
     cutoff: prop_cutoff
 
     def execute(self, context):
+        check_morph_precision(self)
         r = re.compile(self.regex)
         m = context.object.data
         if not m.shape_keys or not m.shape_keys.key_blocks or not m.shape_keys.reference_key:
@@ -417,12 +479,37 @@ class OpMorphsExport(DirExport):
                     self.report({"ERROR"}, name + f"{name}{ext} already exists!")
                     return {"CANCELLED"}
 
-        exp = MorphExporter(context.object, self.cutoff, float_dtype(self.precision))
+        # Write files in background threads while next morphs are being calculated.
+        # Each pending write holds a copy of the morph, so wait for the oldest one when too many are queued.
+        max_workers = 2
+        pending = collections.deque()
+        errors = []
 
-        for name, sk in keys.items():
-            if sk == exp.rk:
-                continue
-            exp.do_export(sk, os.path.join(self.directory, name))
+        def wait_oldest():
+            try:
+                pending.popleft().result()
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(str(e))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            def submit(*args, **kwargs):
+                if len(pending) >= max_workers * 2:
+                    wait_oldest()
+                pending.append(executor.submit(*args, **kwargs))
+
+            exp = MorphExporter(context.object, self.cutoff, float_dtype(self.precision), submit)
+
+            for name, sk in keys.items():
+                if sk == exp.rk:
+                    continue
+                exp.do_export(sk, os.path.join(self.directory, name))
+
+            while pending:
+                wait_oldest()
+
+        if errors:
+            self.report({"ERROR"}, f"Failed to write {len(errors)} morph file(s): {errors[0]}")
+            return {"CANCELLED"}
 
         return {"FINISHED"}
 
@@ -502,7 +589,9 @@ class OpMorphsImport(bpy.types.Operator, bpy_extras.io_utils.ImportHelper):
 # There seems to be bug in pylint with numpy's nonzero function
 # pylint: disable=no-member
 def sel_arr(items):
-    return numpy.array([x.select for x in items], dtype=bool).nonzero()[0].astype(dtype=numpy.uint16)
+    sel = numpy.empty(len(items), dtype=bool)
+    items.foreach_get("select", sel)
+    return sel.nonzero()[0].astype(dtype=numpy.uint16)
 
 
 class OpSubsetExport(bpy.types.Operator, bpy_extras.io_utils.ExportHelper):
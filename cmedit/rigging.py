@@ -55,16 +55,29 @@ def joint_list_extended(context, xmirror):
     result = selected_joints(context)
     bones = context.object.data.edit_bones
     kd = kdtree_from_bones(bones)
+    seen = set()
+    collections = {}
+
+    def get_collections(bone):
+        colls = collections.get(bone.name)
+        if colls is None:
+            colls = list(utils.bone_get_collections(bone))
+            collections[bone.name] = colls
+        return colls
+
     for name, (bone, attr) in list(result.items()):
         co = getattr(bone, attr)
         checklist = [co]
         if xmirror:
-            checklist.append(mathutils.Vector((-co[0], co[1], co[2])))
+            checklist.append((-co[0], co[1], co[2]))
         for co2 in checklist:
             for _, jid, _ in kd.find_range(co2, 0.00001):
+                if jid in seen:
+                    continue
                 bone2 = bones[jid // 2]
-                if list(utils.bone_get_collections(bone2)) != list(utils.bone_get_collections(bone)):
+                if get_collections(bone2) != get_collections(bone):
                     continue
+                seen.add(jid)
                 attr = "head" if jid & 1 == 0 else "tail"
                 name = f"joint_{bone2.name}_{attr}"
                 if name not in result:
@@ -18,6 +18,7 @@
 #
 # Copyright (C) 2021 Michael Vigovsky
 
+import functools, numpy
 import bpy, mathutils  # pylint: disable=import-error
 
 from ..lib import utils
@@ -27,6 +28,7 @@ def is_deform(group_name):
     return group_name.startswith("DEF-") or group_name.startswith("MCH-") or group_name.startswith("ORG-")
 
 
+@functools.lru_cache(maxsize=4096)
 def swap_l_r(name):
     new_name = name.replace(".L", ".R").replace("_L_", "_R_").replace(".l", ".r").replace("_l_", "_r_")
     if new_name != name:
@@ -34,15 +36,24 @@ def swap_l_r(name):
     return name.replace(".R", ".L").replace("_R_", "_L_").replace(".r", ".l").replace("_r_", "_l_")
 
 
-def counterpart_vertex(verts, kd, v):
-    counterparts = kd.find_range(mathutils.Vector((-v.co[0], v.co[1], v.co[2])), 0.00001)
-    if len(counterparts) == 0:
-        print(v.index, v.co, "no counterpart")
-        return None
-    if len(counterparts) > 1:
-        print(v.index, v.co, "multiple counterparts:", counterparts)
-        return None
-    return verts[counterparts[0][1]]
+# Map vertex indices from idx to indices of their X-mirrored counterparts,
+# vertices without unique counterpart are skipped
+def counterpart_indices(co, kd, idx):
+    result = {}
+    for i, (x, y, z) in zip(idx, co[idx].tolist()):
+        counterparts = kd.find_range((-x, y, z), 0.00001)
+        if len(counterparts) == 0:
+            print(i, (x, y, z), "no counterpart")
+        elif len(counterparts) > 1:
+            print(i, (x, y, z), "multiple counterparts:", counterparts)
+        else:
+            result[i] = counterparts[0][1]
+    return result
+
+
+def mesh_coords_kd(mesh):
+    co = utils.verts_to_numpy(mesh.vertices, numpy.float32)
+    return co, utils.mesh_cached(mesh, "kd", (co,), lambda: utils.kdtree_from_np(co))
 
 
 class OpCheckSymmetry(bpy.types.Operator):
@@ -57,34 +68,35 @@ class OpCheckSymmetry(bpy.types.Operator):
     def execute(self, context):  # pylint: disable=no-self-use
         obj = context.object
         mesh = obj.data
-        kd = utils.kdtree_from_verts(mesh.vertices)
+        verts = mesh.vertices
+        co, kd = mesh_coords_kd(mesh)
+        names = [vg.name for vg in obj.vertex_groups]
+        deform = [is_deform(name) for name in names]
+        name_idx = {name: i for i, name in enumerate(names)}
+        counterpart_vg = [name_idx.get(swap_l_r(name), -1) for name in names]
 
         def groups_to_list(group):
-            return [(obj.vertex_groups[g.group].name, g.weight) for g in group]
-        for v in mesh.vertices:
-            if v.co[0] == 0 or v.co[0] == -0:
-                continue
-            v2 = counterpart_vertex(mesh.vertices, kd, v)
-            if v2 is None:
-                continue
+            return [(names[g.group], g.weight) for g in group]
+        for i, i2 in counterpart_indices(co, kd, (co[:, 0] != 0).nonzero()[0].tolist()).items():
+            v = verts[i]
+            v2 = verts[i2]
             if len(v.groups) != len(v2.groups):
                 print(v.index, v.co, "vg mismatch:", groups_to_list(v.groups), groups_to_list(v2.groups))
 
-            gdict = {obj.vertex_groups[g.group].name: (obj.vertex_groups[g.group], g.weight) for g in v2.groups}
+            gdict = {g.group: g.weight for g in v2.groups}
 
             wgt = 0
 
             for g in v.groups:
-                g1 = obj.vertex_groups[g.group]
-                if is_deform(g1.name):
+                g1_name = names[g.group]
+                if deform[g.group]:
                     wgt += g.weight
-                g2_name = swap_l_r(g1.name)
-                g2, g2_weight = gdict.get(g2_name, (None, None))
-                if not g2:
-                    print(v.index, v.co, g1.name, g.weight, "vg counterpart not found")
+                g2_weight = gdict.get(counterpart_vg[g.group])
+                if g2_weight is None:
+                    print(v.index, v.co, g1_name, g.weight, "vg counterpart not found")
                     continue
                 if abs(g.weight - g2_weight) >= 0.01:
-                    print(v.index, v.co, g1.name, "vg weight mismatch:", g.weight, g2_weight)
+                    print(v.index, v.co, g1_name, "vg weight mismatch:", g.weight, g2_weight)
                     continue
 
             if abs(wgt - 1) >= 0.0001:
@@ -114,18 +126,14 @@ class OpSymmetrizeVG(bpy.types.Operator):
         vg = obj.vertex_groups.active
         idx = vg.index
         mesh = obj.data
-        kd = utils.kdtree_from_verts(mesh.vertices)
-        for v in mesh.vertices:
-            if v.co[0] < 1e-30:
-                continue
-            v2 = counterpart_vertex(mesh.vertices, kd, v)
-            if v2 is None:
-                continue
-            w = (get_group_weight(v, idx) + get_group_weight(v2, idx)) / 2
+        verts = mesh.vertices
+        co, kd = mesh_coords_kd(mesh)
+        for i, i2 in counterpart_indices(co, kd, (co[:, 0] >= 1e-30).nonzero()[0].tolist()).items():
+            w = (get_group_weight(verts[i], idx) + get_group_weight(verts[i2], idx)) / 2
             if w >= 1e-5:
-                vg.add([v.index, v2.index], w, "REPLACE")
+                vg.add([i, i2], w, "REPLACE")
             else:
-                vg.remove([v.index, v2.index])
+                vg.remove([i, i2])
         return {"FINISHED"}
 
 
@@ -144,8 +152,18 @@ class OpSymmetrizeWeights(bpy.types.Operator):
         mesh = obj.data
         if mesh.is_editmode:
             obj.update_from_editmode()
-        kd = utils.kdtree_from_verts(mesh.vertices)
-        for v in mesh.vertices:
+        verts = mesh.vertices
+        co, kd = mesh_coords_kd(mesh)
+        sel = numpy.empty(len(verts), dtype=bool)
+        verts.foreach_get("select", sel)
+        counterparts = counterpart_indices(co, kd, (sel & (co[:, 0] != 0)).nonzero()[0].tolist())
+        vgroups = list(obj.vertex_groups)
+        names = [vg.name for vg in vgroups]
+        deform = [is_deform(name) for name in names]
+        locked = [vg.lock_weight for vg in vgroups]
+        name_idx = {name: i for i, name in enumerate(names)}
+        counterpart_vg = [name_idx.get(swap_l_r(name), -1) for name in names]
+        for v in verts:
             if not v.select:
                 continue
 
@@ -153,7 +171,7 @@ class OpSymmetrizeWeights(bpy.types.Operator):
                 groups = []
                 wgt = 0
                 for ge in v.groups:
-                    if is_deform(obj.vertex_groups[ge.group].name):
+                    if deform[ge.group]:
                         wgt += ge.weight
                         groups.append(ge)
                 if abs(wgt - 1) < 0.0001:
@@ -163,27 +181,27 @@ class OpSymmetrizeWeights(bpy.types.Operator):
             if v.co[0] == 0 or v.co[0] == -0:
                 normalize(v)
                 continue
-            v2 = counterpart_vertex(mesh.vertices, kd, v)
-            if v2 is None:
+            i2 = counterparts.get(v.index)
+            if i2 is None:
                 print("no counterpart", v.index)
                 continue
-            gdict = {obj.vertex_groups[g.group].name: g for g in v2.groups}
+            v2 = verts[i2]
+            gdict = {g.group: g for g in v2.groups}
 
             wgt2 = 0
             # cleanup groups without counterparts before normalizing
             for g in v.groups:
-                if g.group > len(obj.vertex_groups) or g.group < 0:
+                if g.group > len(vgroups) or g.group < 0:
                     print("bad vg id", v.index, g.group)
                     continue
-                vg = obj.vertex_groups[g.group]
-                g2e = gdict.get(swap_l_r(vg.name))
-                if g2e:
-                    if is_deform(vg.name):
+                g2e = gdict.get(counterpart_vg[g.group])
+                if g2e is not None:
+                    if deform[g.group]:
                         wgt2 += g2e.weight
-                elif not vg.lock_weight:
-                    if not is_deform(vg.name):
-                        print("removing non-deform vg", v.index, v2.index, v.co, vg.name)
-                    vg.remove([v.index])
+                elif not locked[g.group]:
+                    if not deform[g.group]:
+                        print("removing non-deform vg", v.index, v2.index, v.co, names[g.group])
+                    vgroups[g.group].remove([v.index])
 
             if wgt2 < 0.0001:
                 print(v.index, v2.index, "situation is too bad, please check")
@@ -194,16 +212,15 @@ class OpSymmetrizeWeights(bpy.types.Operator):
             normalize(v)
 
             for g1e in v.groups:
-                vg = obj.vertex_groups[g1e.group]
-                if vg.lock_weight:
+                if locked[g1e.group]:
                     continue
-                g2name = swap_l_r(vg.name)
-                g2e = gdict[g2name]
+                g2idx = counterpart_vg[g1e.group]
+                g2e = gdict[g2idx]
                 g2w = g2e.weight
-                if is_deform(g2name):
+                if deform[g2idx]:
                     g2w /= wgt2
                 if g2w > 1:
-                    print(v.index, v2.index, g2name, g2e.group, g2e.weight, g2w, wgt2)
+                    print(v.index, v2.index, names[g2idx], g2e.group, g2e.weight, g2w, wgt2)
                     self.report({'ERROR'}, "Bad g2 weight!")
                     return {"FINISHED"}
 
@@ -232,7 +249,7 @@ class OpSymmetrizeJoints(bpy.types.Operator):
     def execute(self, context):  # pylint: disable=no-self-use
         obj = context.object
         mesh = obj.data
-        kd = utils.kdtree_from_verts(mesh.vertices)
+        co, kd = mesh_coords_kd(mesh)
         vg_map = {}
         new_vg = set()
         for vg in obj.vertex_groups:
@@ -246,25 +263,34 @@ class OpSymmetrizeJoints(bpy.types.Operator):
                 new_vg.add(cvg.index)
             vg_map[vg.index] = cvg
 
+        # Weights for newly created groups are collected first and written with one call per distinct weight
+        new_weights = {idx: {} for idx in new_vg}
         for v in mesh.vertices:
+            counterparts = None
             for g in v.groups:
                 if g.group in new_vg:
                     continue
                 cvg = vg_map.get(g.group)
                 if cvg is None:
                     continue
-                v2 = counterpart_vertex(mesh.vertices, kd, v)
-                if v2 is None:
+                if counterparts is None:
+                    counterparts = counterpart_indices(co, kd, [v.index])
+                i2 = counterparts.get(v.index)
+                if i2 is None:
                     continue
                 if cvg.index in new_vg:
-                    cvg.add([v2.index], g.weight, "REPLACE")
+                    new_weights[cvg.index][i2] = g.weight
                 else:
                     try:
-                        w2 = cvg.weight(v2.index)
+                        w2 = cvg.weight(i2)
                     except RuntimeError:
                         w2 = 0
                     if abs(g.weight - w2) >= 1e-5:
-                        print("assymetry:", cvg.name, v.index, g.weight, v2.index, w2)
+                        print("assymetry:", cvg.name, v.index, g.weight, i2, w2)
+
+        for idx, weights in new_weights.items():
+            if weights:
+                utils.vg_add_arrays(obj.vertex_groups[idx], list(weights.keys()), list(weights.values()))
 
         return {"FINISHED"}
 
@@ -18,7 +18,7 @@
 #
 # Copyright (C) 2021 Michael Vigovsky
 
-import math
+import math, numpy
 import bpy, mathutils  # pylint: disable=import-error
 
 from ..lib import utils
@@ -27,21 +27,43 @@ from ..lib import utils
 def closest_point_on_face(face, co):
     if len(face) == 3:
         return mathutils.geometry.closest_point_on_tri(co, face[0], face[1], face[2])
-    results = []
-    for _ in range(len(face)):
-        results.append(mathutils.geometry.closest_point_on_tri(co, face[0], face[1], face[2]))
-        face = face[1:] + face[:1]
-    results.sort(key=lambda elem: (elem - co).length)
-    return (results[0] + results[1]) / 2
-
-
-def dist_edge(co, v1, v2):
-    co2, dist = mathutils.geometry.intersect_point_line(co, v1, v2)
-    if dist <= 0:
-        return (v1 - co).length
-    if dist >= 1:
-        return (v2 - co).length
-    return (co2 - co).length
+    if len(face) == 4:
+        p1 = mathutils.geometry.closest_point_on_tri(co, face[0], face[1], face[2])
+        p2 = mathutils.geometry.closest_point_on_tri(co, face[0], face[2], face[3])
+        return p1 if (p1 - co).length_squared <= (p2 - co).length_squared else p2
+    # Triangulate the face as a fan around the first vertex and take the closest point among all triangles
+    return min(
+        (mathutils.geometry.closest_point_on_tri(co, face[0], face[i], face[i + 1]) for i in range(1, len(face) - 1)),
+        key=lambda elem: (elem - co).length_squared)
+
+
+# Squared distances from co to every segment in an (N, 2, 3) array of edge end coordinates
+def dist_edges(co, edges):
+    v1 = edges[:, 0]
+    d = edges[:, 1] - v1
+    dd = numpy.einsum("ij,ij->i", d, d)
+    t = numpy.einsum("ij,ij->i", co - v1, d)
+    numpy.divide(t, dd, out=t, where=dd > 0)
+    numpy.clip(t, 0, 1, out=t)
+    foot = v1 + t[:, None] * d
+    foot -= co
+    return numpy.einsum("ij,ij->i", foot, foot)
+
+
+# Find lines between all pairs of verts that pass close enough to co.
+# Returns indices of line ends in verts, distances to co and positions of projected co on the lines
+def cross_lines(verts, co):
+    i, j = numpy.triu_indices(len(verts), 1)
+    a = verts[i]
+    d = verts[j] - a
+    dd = numpy.einsum("ij,ij->i", d, d)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        p = numpy.einsum("ij,ij->i", co - a, d) / dd
+    a += p[:, None] * d
+    a -= co
+    dist = numpy.einsum("ij,ij->i", a, a)
+    mask = (p >= 0) & (p <= 1) & (dist * 4 < dd)
+    return i[mask], j[mask], numpy.sqrt(dist[mask]), p[mask]
 
 
 def barycentric_weight_calc(veclist, co):
@@ -51,63 +73,67 @@ def barycentric_weight_calc(veclist, co):
     return result
 
 
-def vg_full_to_avg(group):
-    if group is None:
-        return None
-    total = 0
-    vec = mathutils.Vector()
-    for co, _, weight in group:
-        total += weight
-        vec += co * weight
-    if total < 0.1:
-        return None
-    return vec / total
+class VGroupData:
+    __slots__ = "idx", "weights", "co"
+    idx: numpy.ndarray
+    weights: numpy.ndarray
+    co: numpy.ndarray
+
+    def __init__(self, idx, weights, verts):
+        self.idx = idx
+        self.weights = weights
+        self.co = verts[idx]
+
+    def __len__(self):
+        return len(self.idx)
+
 
+# Vertex group weights are passed around as (vertex indices, weights) array pairs
 
-def vg_full_to_dict(group):
-    return {tup[1]: tup[2] for tup in group}
+def vg_make(idx, weights):
+    return numpy.asarray(idx, dtype=numpy.intp), numpy.asarray(weights, dtype=numpy.float64)
+
+
+def vg_full_weights(group):
+    return group.idx, group.weights
 
 
 def vg_mult(vg, coeff):
-    for idx, weight in vg.items():
-        vg[idx] = weight * coeff
+    return vg[0], vg[1] * coeff
+
+
+# Weighted sum of (vg, coeff) pairs, weights of shared vertices are added together
+def vg_sum(groups):
+    groups = list(groups)
+    idx, inv = numpy.unique(numpy.concatenate([vg[0] for vg, _ in groups]), return_inverse=True)
+    return idx, numpy.bincount(inv.reshape(-1), numpy.concatenate([vg[1] * coeff for vg, coeff in groups]), len(idx))
 
 
 def vg_add(a, b, coeff=1):
-    if isinstance(b, dict):
-        b = b.items()
-    for idx, weight in b:
-        a[idx] = a.get(idx, 0) + weight * coeff
-    return a
+    return vg_sum(((a, 1), (b, coeff)))
 
 
 def vg_mix2(a, b, factor):
     if factor < 1e-30:
         return a
     if factor >= 1:
-        a.clear()
-        a.update(b)
-        return a
-    vg_mult(a, (1 - factor) / sum(a.values()))
-    return vg_add(a, b, factor / sum(b.values()))
+        return b
+    return vg_add(vg_mult(a, (1 - factor) / a[1].sum()), b, factor / b[1].sum())
 
 
 def vg_mixmany(groups):
     groups = [
         (group, gweight / gsum)
         for group, gweight, gsum in (
-            (group, gweight, sum(group.values()))
+            (group, gweight, group[1].sum())
             for group, gweight in groups
         ) if gsum >= 1e-30
     ]
     if len(groups) == 0:
         return "No groups were found by the calculation method"
-    result = groups[0][0]
-    if len(groups) > 1:
-        vg_mult(result, groups[0][1])
-    for group, coeff in groups[1:]:
-        vg_add(result, group, coeff)
-    return result
+    if len(groups) == 1:
+        return groups[0][0]
+    return vg_sum(groups)
 
 
 def get_offs(bone, attr):
@@ -126,17 +152,20 @@ def overwrite_vg(vertex_groups, name):
 def calc_lst(co, lst):
     if lst is None or len(lst) == 0:
         return "No vertices were found by the calc method"
-    return dict(zip([tup[1] for tup in lst], barycentric_weight_calc([tup[0] for tup in lst], co)))
+    coords, idx = tuple(zip(*lst))[:2]
+    return vg_make(idx, barycentric_weight_calc(coords, co))
 
 
+# groups is an iterable of (VGroupData, average coordinate) pairs
 def calc_group_weights(groups, co):
     groups2 = []
     coords = []
-    for g in groups:
-        co2 = vg_full_to_avg(g)
+    for g, co2 in groups:
         if co2 is not None:
-            groups2.append(vg_full_to_dict(g))
+            groups2.append(vg_full_weights(g))
             coords.append(co2)
+    if len(coords) == 0:
+        return []
     return list(zip(groups2, barycentric_weight_calc(coords, co)))
 
 
@@ -169,144 +198,179 @@ class VGCalculator:
 
     @utils.lazyproperty
     def vg_full(self):
-        return utils.get_vg_data(
-            self.char, lambda: [],
-            lambda data_item, v, co, gw: data_item.append((co, v.index, gw.weight)))
+        verts = self.coords_np
+        groups = utils.vg_weights_to_arrays(self.char, lambda name: name.startswith("joint_"))
+        return {
+            name: VGroupData(numpy.array(idx, dtype=numpy.uint32), numpy.array(weights, dtype=numpy.float32), verts)
+            for name, idx, weights in zip(*groups)
+            if len(idx) > 0
+        }
 
     @utils.lazyproperty
     def vg_avg(self):
         return utils.get_vg_avg(self.char)
 
+    @utils.lazyproperty
+    def coords_np(self):
+        return utils.verts_to_numpy(self.char.data.vertices, numpy.float32)
+
     @utils.lazyproperty
     def kd_verts(self):
-        return utils.kdtree_from_verts(self.char.data.vertices)
+        return utils.mesh_cached(self.char.data, "kd", (self.coords_np,), lambda: utils.kdtree_from_np(self.coords_np))
+
+    @utils.lazyproperty
+    def faces(self):
+        return utils.mesh_faces(self.char.data)
 
     @utils.lazyproperty
     def bvh(self):
-        return mathutils.bvhtree.BVHTree.FromPolygons(
-            [v.co for v in self.char.data.vertices],
-            [f.vertices for f in self.char.data.polygons])
+        return utils.mesh_cached(
+            self.char.data, "bvh", (self.coords_np, self.faces),
+            lambda: mathutils.bvhtree.BVHTree.FromPolygons(self.coords_np, self.faces))
 
+    @utils.lazyproperty
+    def edge_verts(self):
+        edges = self.char.data.edges
+        result = numpy.empty(len(edges) * 2, dtype=numpy.int32)
+        edges.foreach_get("vertices", result)
+        return result.reshape(-1, 2)
+
+    @utils.lazyproperty
+    def edges_xyz(self):
+        return self.coords_np[self.edge_verts]
+
+    # Vertex to edge map in CSR layout: edges of vertex v are edges[offs[v]:offs[v+1]]
     @utils.lazyproperty
     def emap(self):
-        result = {}
-        for edge in self.char.data.edges:
-            for vert in edge.vertices:
-                item = result.get(vert)
-                if item is None:
-                    item = []
-                    result[vert] = item
-                item.append(edge.index)
-        return result
+        return utils.mesh_cached(self.char.data, "emap", (self.edge_verts, len(self.coords_np)), self._calc_emap)
+
+    def _calc_emap(self):
+        ev = self.edge_verts.reshape(-1)
+        counts = numpy.bincount(ev, minlength=len(self.coords_np))
+        offs = numpy.zeros(len(counts) + 1, dtype=numpy.intp)
+        numpy.cumsum(counts, out=offs[1:])
+        return offs, numpy.argsort(ev, kind="stable") // 2
+
+    # Weighted average positions of all joint groups, None for groups with too little total weight
+    @utils.lazyproperty
+    def vg_full_avg(self):
+        groups = self.vg_full
+        if not groups:
+            return {}
+        lens = [len(group) for group in groups.values()]
+        offs = numpy.cumsum([0] + lens[:-1])
+        weights = numpy.concatenate([group.weights for group in groups.values()]).astype(numpy.float64)
+        co = numpy.concatenate([group.co for group in groups.values()]) * weights[:, None]
+        totals = numpy.add.reduceat(weights, offs)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            avg = numpy.add.reduceat(co, offs) / totals[:, None]
+        return {
+            name: mathutils.Vector(co) if total >= 0.1 else None
+            for name, co, total in zip(groups, avg.tolist(), totals.tolist())
+        }
 
     @utils.lazyproperty
     def kd_joints(self):
         all_groups = self.vg_full
         kd = mathutils.kdtree.KDTree(len(all_groups))
         self.kdj_groups = []
-        for name, group in all_groups.items():
-            co = vg_full_to_avg(group)
+        for name, co in self.vg_full_avg.items():
             if co is not None:
                 kd.insert(co, len(self.kdj_groups))
-                self.kdj_groups.append((name, group))
+                self.kdj_groups.append((name, all_groups[name]))
         kd.balance()
         return kd
 
     # Calc functions
 
     def calc_bb(self, co):
-        lst = [(None, None, None) for _ in range(8)]
-        for idx, vert in enumerate(self.char.data.vertices):
-            vco = vert.co
-            for bv in range(8):
-                for coord in range(3):
-                    if bv >> coord & 1 != (1 if vco[coord] > co[coord] else 0):
-                        break
-                else:
-                    dist = sum(abs(vco[coord] - co[coord]) for coord in range(3))
-                    if lst[bv][2] is None or lst[bv][2] > dist:
-                        lst[bv] = (vco, idx, dist)
-                    break
-        for item in lst:
-            if item[0] is None:
+        verts = self.coords_np
+        diff = verts - numpy.array(co, dtype=verts.dtype)
+        octants = (diff > 0).dot((1, 2, 4))
+        dists = numpy.abs(diff).sum(1)
+
+        bb_idx = []
+        for bv in range(8):
+            sel = (octants == bv).nonzero()[0]
+            if len(sel) == 0:
                 return "Not all bbox points was found"
+            bb_idx.append(sel[dists[sel].argmin()])
 
-        front_face = [item[0] for item in lst[:4]]
-        back_face = [item[0] for item in lst[4:]]
+        # Octants 2 and 3 are swapped to get the face vertices in polygon order
+        quad = [0, 1, 3, 2]
+        bb_idx = numpy.array(bb_idx)
+        front = verts[bb_idx[quad]].astype(numpy.float64)
+        back = verts[bb_idx[4:][quad]].astype(numpy.float64)
+        front_face = [mathutils.Vector(v) for v in front.tolist()]
+        back_face = [mathutils.Vector(v) for v in back.tolist()]
 
-        front_face[2], front_face[3] = front_face[3], front_face[2]
-        back_face[2], back_face[3] = back_face[3], back_face[2]
+        weights_front = numpy.array(barycentric_weight_calc(front_face, closest_point_on_face(front_face, co)))
+        weights_back = numpy.array(barycentric_weight_calc(back_face, closest_point_on_face(back_face, co)))
 
-        weights_front = barycentric_weight_calc(front_face, closest_point_on_face(front_face, co))
-        weights_back = barycentric_weight_calc(back_face, closest_point_on_face(back_face, co))
+        avg_front = weights_front.dot(front)
+        axis = weights_back.dot(back) - avg_front
+        offs = min(max((numpy.array(co) - avg_front).dot(axis) / axis.dot(axis), 0), 1)
 
-        avg_front = sum((co * weight for co, weight in zip(front_face, weights_front)), mathutils.Vector())
-        avg_back = sum((co * weight for co, weight in zip(back_face, weights_back)), mathutils.Vector())
-        axis = avg_back - avg_front
-        offs = min(max((co - avg_front).dot(axis) / axis.dot(axis), 0), 1)
-
-        weights_front[2], weights_front[3] = weights_front[3], weights_front[2]
-        weights_back[2], weights_back[3] = weights_back[3], weights_back[2]
-
-        weights = [w * (1 - offs) for w in weights_front] + [w * offs for w in weights_back]
-
-        return {item[1]: weight for item, weight in zip(lst, weights)}
+        return vg_make(bb_idx, numpy.concatenate((weights_front[quad] * (1 - offs), weights_back[quad] * offs)))
 
     def calc_cu(self, co):
-        lst = self.vg_full.get(self.cur_name)
-        if lst is None or len(lst) == 0:
+        group = self.vg_full.get(self.cur_name)
+        if group is None or len(group) == 0:
             return "No vertices in current group"
 
-        if len(lst) > 256:
+        if len(group) > 256:
             return "Too many vertices in current group"
 
         # Solving travelling salesman problem by nearest neighbour algorithm
-        slst = [lst[0]]
-        co1 = lst[0][0]
-        lst = lst[1:]
-        while len(lst) > 0:
-            idx = 0
-            dist = (lst[0][0] - co1).length
-            for i, item in enumerate(lst[1:]):
-                dist2 = (item[0] - co1).length
-                if dist2 < dist:
-                    idx = i + 1
-                    dist = dist2
-            slst.append(lst[idx])
-            co1 = lst[idx][0]
-            del lst[idx]
+        kd = utils.kdtree_from_np(group.co)
+        visited = bytearray(len(group))
+
+        def nearest_unvisited(co1):
+            n = 8
+            while True:
+                for _, i, _ in kd.find_n(co1, n):
+                    if not visited[i]:
+                        return i
+                n *= 4
+
+        i = 0
+        slst = []
+        while True:
+            visited[i] = 1
+            co1 = mathutils.Vector(group.co[i])
+            slst.append((co1, int(group.idx[i])))
+            if len(slst) == len(group):
+                break
+            i = nearest_unvisited(co1)
 
         return calc_lst(co, slst)
 
     def calc_ne(self, co):
-        verts = self.char.data.vertices
-        edges = self.char.data.edges
-        lst = None
-        mindist = 1e30
-        for _, vert, _ in self.kd_verts.find_n(co, 32):
-            for edge in self.emap[vert]:
-                v1, v2 = tuple((verts[i].co, i) for i in edges[edge].vertices)
-                dist = dist_edge(co, v1[0], v2[0])
-                if dist < mindist:
-                    mindist = dist
-                    lst = [v1, v2]
-
-        return calc_lst(co, lst)
+        offs, edges = self.emap
+        cand = [edges[offs[vert]:offs[vert + 1]] for _, vert, _ in self.kd_verts.find_n(co, 32)]
+        if not cand:
+            return calc_lst(co, None)
+        cand = numpy.concatenate(cand)
+        if len(cand) == 0:
+            return calc_lst(co, None)
+        edge = cand[dist_edges(numpy.array(co, dtype=numpy.float32), self.edges_xyz[cand]).argmin()]
+        return calc_lst(co, [(mathutils.Vector(self.coords_np[i]), i) for i in self.edge_verts[edge].tolist()])
 
     def calc_face(self, co, idx):
         if idx is None:
             return "Face not found"
-        verts = [(self.char.data.vertices[i].co, i) for i in self.char.data.polygons[idx].vertices]
+        coords = self.coords_np
+        verts = [(mathutils.Vector(coords[i]), i) for i in self.faces[idx]]
         if self.ui.vg_snap > 1e-30:
             for co2, idx1 in verts:
                 if (co2 - co).length < self.ui.vg_snap:
-                    return {idx1: 1}
+                    return vg_make([idx1], [1])
 
             for i, (co2, idx2) in enumerate(verts):
                 co1, idx1 = verts[i - 1]
                 co3, p = mathutils.geometry.intersect_point_line(co, co1, co2)
                 if (co3 - co).length < self.ui.vg_snap and 0 <= p <= 1:
-                    return {idx1: 1 - p, idx2: p}
+                    return vg_make([idx1, idx2], [1 - p, p])
 
         return calc_lst(co, verts)
 
@@ -315,25 +379,20 @@ class VGCalculator:
         return self.calc_face(co2, idx)
 
     def calc_xl(self, co):
-        verts = self.kd_verts.find_n(co, self.ui.vg_xl_vn)
-        lns = []
-        for i in range(len(verts) - 1):
-            for j in range(i + 1, len(verts)):
-                co1 = verts[i][0]
-                co2 = verts[j][0]
-                co3, p = mathutils.geometry.intersect_point_line(co, co1, co2)
-                if p < 0 or p > 1:
-                    continue
-                d = (co3 - co).length
-                if d < (co2 - co1).length / 2:
-                    lns.append((verts[i][1], verts[j][1], d, p))
-
-        lns.sort(key=lambda tup: tup[2])
-        lns = lns[:self.ui.vg_xl_n]
-        if len(lns) == 0:
+        idx = numpy.array([tup[1] for tup in self.kd_verts.find_n(co, self.ui.vg_xl_vn)], dtype=numpy.intp)
+        i, j, d, p = cross_lines(self.coords_np[idx], numpy.array(co, dtype=numpy.float32))
+        if len(d) == 0:
             return "No cross lines found"
 
-        return vg_add({}, (tup for i, j, _, p in lns for tup in ((i, 1 - p), (j, p))))
+        n = self.ui.vg_xl_n
+        if len(d) > n:
+            sel = numpy.argpartition(d, n)[:n]
+            i, j, p = i[sel], j[sel], p[sel]
+
+        vn = len(idx)
+        weights = numpy.bincount(i, 1 - p, vn) + numpy.bincount(j, p, vn)
+        used = (numpy.bincount(i, minlength=vn) + numpy.bincount(j, minlength=vn)).nonzero()[0]
+        return idx[used], weights[used]
 
     def _cast_rays(self, co, d):
         b = self.bvh
@@ -348,19 +407,19 @@ class VGCalculator:
     def _calc_rays(self, co, callback):
         if not self.ui.vg_x and not self.ui.vg_y and not self.ui.vg_z:
             return "No axes selected"
-        result = {}
+        result = []
 
         def cast(d):
             vg = self._cast_rays(co, d)
             if vg is not None:
-                vg_add(result, vg)
+                result.append((vg, 1))
 
         callback(cast, co)
 
         if not result:
             return "Ray cast failed"
 
-        return result
+        return vg_sum(result)
 
     def _rays_bone(self, cast, _):
         def cast_perp(axis, y):
@@ -429,24 +488,27 @@ class VGCalculator:
         def get_head(bone):
             if bone is None:
                 return None
-            result = vgroups.get("joint_" + bone.name + "_head")
-            if result is not None:
+            result = "joint_" + bone.name + "_head"
+            if result in vgroups:
                 return result
             if bone.parent is None:
                 return None
-            return vgroups.get("joint_" + bone.parent.name + "_tail")
+            return "joint_" + bone.parent.name + "_tail"
 
         bone = self.cur_bone
         if self.cur_attr == "head":
-            groups = [get_head(bone.parent), vgroups.get(f"joint_{bone.name}_tail")]
+            names = [get_head(bone.parent), f"joint_{bone.name}_tail"]
         else:
-            groups = [get_head(bone)] + [vgroups.get(f"joint_{child.name}_tail") for child in bone.children]
+            names = [get_head(bone)] + [f"joint_{child.name}_tail" for child in bone.children]
 
-        groups = (g for g in groups if g is not None)
+        names = [name for name in names if name in vgroups]
+        if len(names) < 2:
+            return "Can't find enough already calculated neighbors"
         if is_nw:
-            groups = calc_group_weights(groups, co)
+            avg = self.vg_full_avg
+            groups = calc_group_weights(((vgroups[name], avg[name]) for name in names), co)
         else:
-            groups = [(vg_full_to_dict(g), 1) for g in groups]
+            groups = [(vg_full_weights(vgroups[name]), 1) for name in names]
         if len(groups) < 2:
             return "Can't find enough already calculated neighbors"
         return vg_mixmany(groups)
@@ -458,7 +520,7 @@ class VGCalculator:
             name, group = self.kdj_groups[idx]
             if name == self.cur_name:
                 continue
-            cur_groups.append(vg_full_to_dict(group))
+            cur_groups.append(vg_full_weights(group))
             coords.append(co2)
             if len(cur_groups) >= self.ui.vg_n:
                 break
@@ -489,7 +551,7 @@ class VGCalculator:
         if a is None:
             return "Nearest bone is not found"
 
-        return vg_mix2(vg_full_to_dict(a), vg_full_to_dict(b), final_p)
+        return vg_mix2(vg_full_weights(a), vg_full_weights(b), final_p)
 
     def run(self, joints):
         if self.ui.vg_widgets:
@@ -497,7 +559,6 @@ class VGCalculator:
             offsets = {k: v[0].tail - v[0].head for k, v in joints.items()}
 
         char = self.char
-        verts = char.data.vertices
 
         calc_func = self.get_calc_func()
 
@@ -512,11 +573,9 @@ class VGCalculator:
                 co1 -= get_offs(bone, attr)
 
             if self.ui.vg_shift > 1e-6:
-                group = self.vg_full.get(name)
-                if group is not None:
-                    co2 = vg_full_to_avg(group)
-                    if co2 is not None:
-                        co1 += (co1 - co2) * self.ui.vg_shift
+                co2 = self.vg_full_avg.get(name)
+                if co2 is not None:
+                    co1 += (co1 - co2) * self.ui.vg_shift
 
             vg_data = calc_func(co1)
             if isinstance(vg_data, str):
@@ -525,29 +584,21 @@ class VGCalculator:
             if self.ui.vg_mix < 1:
                 group = self.vg_full.get(name)
                 if group is not None:
-                    vg_mix2(vg_data, vg_full_to_dict(group), 1 - self.ui.vg_mix)
+                    vg_data = vg_mix2(vg_data, vg_full_weights(group), 1 - self.ui.vg_mix)
 
-            coeff = max(vg_data.values())
+            coeff = vg_data[1].max(initial=0)
             if coeff < 1e-30:
                 return name + ": empty vg returned"
 
-            coeff = 1 / coeff
-            co2 = mathutils.Vector()
-            wsum = 0.0
+            vg_data = vg_mult(vg_data, 1 / coeff)
 
-            vg = overwrite_vg(char.vertex_groups, name)
+            buckets = utils.vg_weight_buckets(*vg_data)
+            utils.vg_add_buckets(overwrite_vg(char.vertex_groups, name), buckets)
             if self.ui.vg_widgets:
-                vgt = overwrite_vg(char.vertex_groups, "joint_" + bone.name + "_tail")
-
-            for idx, weight in vg_data.items():
-                weight *= coeff
-                vg.add([idx], weight, 'REPLACE')
-                if self.ui.vg_widgets:
-                    vgt.add([idx], weight, 'REPLACE')
-                co2 += verts[idx].co * weight
-                wsum += weight
+                utils.vg_add_buckets(overwrite_vg(char.vertex_groups, "joint_" + bone.name + "_tail"), buckets)
 
-            co2 /= wsum
+            idx, weights = vg_data
+            co2 = mathutils.Vector(weights.dot(self.coords_np[idx]) / weights.sum())
 
             k = "charmorph_offs_" + attr
             if self.ui.vg_offs == "R":
@@ -103,7 +103,7 @@ class Geometry:
 
 
 def mesh_faces(mesh):
-    return [f.vertices for f in mesh.polygons]
+    return utils.mesh_faces(mesh)
 
 
 def geom_mesh(mesh):
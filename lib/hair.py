@@ -27,45 +27,49 @@ from . import fit_calc, utils
 logger = logging.getLogger(__name__)
 
 def np_particles_data(obj, particles, precision=numpy.float32):
+    hk_lens = [len(p.hair_keys) for p in particles]
     cnt = numpy.empty(len(particles), dtype=numpy.uint8)
     total = 0
-    mx = 1
-    for i, p in enumerate(particles):
-        c = len(p.hair_keys) - 1
+    for i, hk_len in enumerate(hk_lens):
+        c = hk_len - 1
         cnt[i] = c
         total += c
-        if c > mx:
-            mx = c
 
-    data = numpy.empty((total, 3), dtype=precision)
-    tmp = numpy.empty(mx * 3 + 3, dtype=precision)
+    # Read all keys straight into one float32 buffer (matches co_local, so foreach_get can just copy memory)
+    # and drop root keys afterwards instead of copying every particle through a temporary array
+    keys = numpy.empty((total + len(hk_lens), 3), dtype=numpy.float32)
+    is_root = numpy.zeros(len(keys), dtype=bool)
     i = 0
-    for p in particles:
-        t2 = tmp[:len(p.hair_keys) * 3]
-        p.hair_keys.foreach_get("co_local", t2)
-        t2 = t2[3:].reshape((-1, 3))
-        data[i:i + len(t2)] = t2
-        i += len(t2)
+    for p, hk_len in zip(particles, hk_lens):
+        if hk_len > 0:
+            p.hair_keys.foreach_get("co_local", keys[i:i + hk_len].reshape(-1))
+            is_root[i] = True
+            i += hk_len
 
+    data = keys[~is_root].astype(dtype=precision, copy=False)
     utils.np_matrix_transform(data, obj.matrix_world.inverted())
     return {"cnt": cnt, "data": data}
 
 
-def export_hair(obj, psys_idx, filepath, precision):
+def export_hair(obj, psys_idx, filepath, precision, compress=True):
     pss = obj.particle_systems
     old_psys_idx = pss.active_index
     pss.active_index = psys_idx
 
     psys = pss[psys_idx]
-    is_global = psys.is_global_hair
-    with bpy.context.temp_override(object=obj):
-        if not is_global:
+    if psys.is_global_hair:
+        data = np_particles_data(obj, psys.particles, precision)
+    else:
+        with bpy.context.temp_override(object=obj):
             bpy.ops.particle.disconnect_hair()
-        numpy.savez_compressed(filepath, **np_particles_data(obj, psys.particles, precision))
-        if not is_global:
-            bpy.ops.particle.connect_hair()
+        try:
+            data = np_particles_data(obj, psys.particles, precision)
+        finally:
+            with bpy.context.temp_override(object=obj):
+                bpy.ops.particle.connect_hair()
 
     pss.active_index = old_psys_idx
+    utils.save_npz(filepath, compress, **data)
 
 
 def update_hair(obj, cnts, morphed):
@@ -18,7 +18,7 @@
 #
 # Copyright (C) 2021-2022 Michael Vigovsky
 
-import os, time, logging, numpy
+import os, io, time, logging, array, numpy
 import bpy, mathutils  # pylint: disable=import-error
 
 logger = logging.getLogger(__name__)
@@ -30,7 +30,7 @@ generative_modifiers = frozenset((
 # YAML stuff
 
 try:
-    from yaml import load as yload, dump as ydump, CSafeLoader as SafeLoader, Dumper
+    from yaml import load as yload, dump as ydump, CSafeLoader as SafeLoader, CDumper as Dumper
 except ImportError:
     from .yaml import load as yload, dump as ydump, SafeLoader, Dumper
     logger.debug("Using bundled yaml library!")
@@ -165,14 +165,32 @@ def kdtree_from_verts_enum(verts, cnt):
     return kd
 
 
-def kdtree_from_verts(verts):
-    return kdtree_from_verts_enum(((idx, vert.co) for idx, vert in enumerate(verts)), len(verts))
-
-
 def kdtree_from_np(verts):
     return kdtree_from_verts_enum(enumerate(verts), len(verts))
 
 
+# Structures derived from the last used mesh, each reused while the data it was built from stays the same
+mesh_cache = {}
+
+
+def _same_data(a, b):
+    if isinstance(a, numpy.ndarray):
+        return numpy.array_equal(a, b)
+    return a == b
+
+
+def mesh_cached(mesh, name, deps, func):
+    ptr = mesh.as_pointer()
+    if any(key[0] != ptr for key in mesh_cache):
+        mesh_cache.clear()
+    entry = mesh_cache.get((ptr, name))
+    if entry is not None and all(_same_data(a, b) for a, b in zip(entry[0], deps)):
+        return entry[1]
+    result = func()
+    mesh_cache[(ptr, name)] = (deps, result)
+    return result
+
+
 def get_basis_verts(data):
     if isinstance(data, bpy.types.Object):
         data = data.data
@@ -182,12 +200,23 @@ def get_basis_verts(data):
     return data.vertices
 
 
-def verts_to_numpy(data):
-    arr = numpy.empty(len(data) * 3)
+def verts_to_numpy(data, dtype=numpy.float64):
+    arr = numpy.empty(len(data) * 3, dtype=dtype)
     data.foreach_get("co", arr)
     return arr.reshape(-1, 3)
 
 
+def mesh_faces(mesh):
+    loops = numpy.empty(len(mesh.loops), dtype=numpy.int32)
+    mesh.loops.foreach_get("vertex_index", loops)
+    starts = numpy.empty(len(mesh.polygons), dtype=numpy.int32)
+    mesh.polygons.foreach_get("loop_start", starts)
+    totals = numpy.empty(len(mesh.polygons), dtype=numpy.int32)
+    mesh.polygons.foreach_get("loop_total", totals)
+    loops = loops.tolist()
+    return [loops[start:start + total] for start, total in zip(starts.tolist(), totals.tolist())]
+
+
 def get_basis_numpy(data):
     return verts_to_numpy(get_basis_verts(data))
 
@@ -321,16 +350,19 @@ def get_vg_data(char, new, accumulate, verts=None):
         def get_co(i):
             return verts[i].co
 
+    # joint group names by group index, None for other groups
+    joints = [vg.name if vg.name.startswith("joint_") else None for vg in char.vertex_groups]
+
     data = {}
     for v in char.data.vertices:
         for gw in v.groups:
-            vg = char.vertex_groups[gw.group]
-            if not vg.name.startswith("joint_"):
+            name = joints[gw.group]
+            if name is None:
                 continue
-            data_item = data.get(vg.name)
+            data_item = data.get(name)
             if not data_item:
                 data_item = new()
-                data[vg.name] = data_item
+                data[name] = data_item
             accumulate(data_item, v, get_co(v.index), gw)
     return data
 
@@ -345,27 +377,42 @@ def get_vg_avg(char, verts=None):
 def vg_weights_to_arrays(obj, name_filter):
     m = {}
     names = []
-    idx = []
-    weights = []
     for vg in obj.vertex_groups:
-        if name_filter(vg.name):
-            m[vg.index] = len(idx)
-            names.append(vg.name)
-            idx.append([])
-            weights.append([])
+        name = vg.name
+        if name_filter(name):
+            m[vg.index] = len(names)
+            names.append(name)
+
+    # Use typed buffers instead of lists to avoid creating Python objects for every weight
+    idx = [array.array("I") for _ in names]
+    weights = [array.array("f") for _ in names]
 
     if len(names) > 0:
+        m_get = m.get
         for v in obj.data.vertices:
+            vi = v.index
             for g in v.groups:
-                i = m.get(g.group)
-                if i is None:
-                    continue
-                idx[i].append(v.index)
-                weights[i].append(g.weight)
+                i = m_get(g.group)
+                if i is not None:
+                    idx[i].append(vi)
+                    weights[i].append(g.weight)
 
     return names, idx, weights
 
 
+def save_npz(file, compress, **arrays):
+    # Build the archive in memory and write it with a single call, it's faster on slow or network drives
+    buf = io.BytesIO()
+    if compress:
+        numpy.savez_compressed(buf, **arrays)
+    else:
+        numpy.savez(buf, **arrays)
+    if not file.endswith(".npz"):
+        file += ".npz"
+    with open(file, "wb") as f:
+        f.write(buf.getbuffer())
+
+
 def np_names(file):
     if not file:
         return ()
@@ -403,9 +450,24 @@ def import_vg(obj, file, overwrite):
                 obj.vertex_groups.remove(obj.vertex_groups[name])
             else:
                 continue
-        vg = obj.vertex_groups.new(name=name)
-        for i, weight in zip(idx, weights):
-            vg.add([int(i)], weight, 'REPLACE')
+        vg_add_arrays(obj.vertex_groups.new(name=name), idx, weights)
+
+
+# Many vertices usually share the same weight, so they are added with a single call per weight value
+def vg_weight_buckets(idx, weights):
+    idx = numpy.asarray(idx)
+    uweights, inv, counts = numpy.unique(weights, return_inverse=True, return_counts=True)
+    groups = numpy.split(idx[numpy.argsort(inv.reshape(-1), kind="stable")], numpy.cumsum(counts)[:-1])
+    return [(weight, lst.tolist()) for weight, lst in zip(uweights.tolist(), groups)]
+
+
+def vg_add_buckets(vg, buckets):
+    for weight, lst in buckets:
+        vg.add(lst, weight, 'REPLACE')
+
+
+def vg_add_arrays(vg, idx, weights):
+    vg_add_buckets(vg, vg_weight_buckets(idx, weights))
 
 
 def bone_get_collections(bone):